@@ -1,25 +1,25 @@
-import ast
+import asyncio
 import dataclasses
+import functools
+import hashlib
 import json
 import logging
+import mmap
 import os
+import random
 import re
+import tempfile
 import time
 from pathlib import Path
-from typing import Optional, Union
+from typing import TYPE_CHECKING, Optional, Union
 
-import openai
-import tiktoken
-from dotenv import load_dotenv
+import orjson
 
-logger = logging.getLogger(__name__)
+if TYPE_CHECKING:
+    import openai
+    import tiktoken
 
-load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
-openai.organization = os.getenv("OPENAI_ORGANIZATION")
-openai.api_type = os.getenv("OPENAI_API_TYPE")
-openai.api_base = os.getenv("OPENAI_API_BASE")
-openai.api_version = os.getenv("OPENAI_API_VERSION")
+logger = logging.getLogger(__name__)
 
 # Data paths
 JP_BENCH_DIR = Path(__file__).resolve().parent.parent / "data" / "jp_bench"
@@ -27,11 +27,20 @@ QUESTION_FILE = JP_BENCH_DIR / "question.jsonl"
 PREDICTION_DIR = JP_BENCH_DIR / "model_answer"
 REFERENCE_DIR = JP_BENCH_DIR / "reference_answer"
 JUDGEMENT_DIR = JP_BENCH_DIR / "model_judgment"
+JUDGEMENT_CACHE_DIR = JUDGEMENT_DIR / ".cache"
 JUDGEMENT_PROMPT_FILE = JP_BENCH_DIR / "judge_prompts.jsonl"
 
 # API setting constants
 API_MAX_RETRY = 16
-API_RETRY_SLEEP = 10
+API_RETRY_MAX_SLEEP = 60
+
+# API prices in USD per 1K (input, output) tokens
+API_PRICES = {
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-0613": (0.03, 0.06),
+    "gpt-4-1106-preview": (0.01, 0.03),
+    "gpt-3.5-turbo": (0.0005, 0.0015),
+}
 
 # Categories that need reference answers
 NEED_REF_CATS = ["math", "reasoning", "coding"]
@@ -39,17 +48,192 @@ NEED_REF_CATS = ["math", "reasoning", "coding"]
 # Extract scores from judgments
 two_score_pattern = re.compile(r"\[\[(\d+\.?\d*),\s?(\d+\.?\d*)]]")
 two_score_pattern_backup = re.compile(r"\[(\d+\.?\d*),\s?(\d+\.?\d*)]")
-one_score_pattern = re.compile(r"\[\[(\d+\.?\d*)]]")
-one_score_pattern_another_format = re.compile(r"\[\[rating:(\d+)]]")
-one_score_pattern_another_format2 = re.compile(r"\[\[rating: (\d+)]]")
+one_score_pattern = re.compile(r"\[\[(\d+\.?\d*)]]|\[\[rating:\s?(\d+)]]")
+winner_pattern = re.compile(r"\[\[([ABC])]]")
+
+
+@functools.cache
+def load_env() -> None:
+    """Load environment variables from `.env` once."""
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+
+@functools.cache
+def get_openai():
+    """Import and configure the `openai` module on first use."""
+    import openai
+
+    load_env()
+    openai.api_key = os.getenv("OPENAI_API_KEY")
+    openai.organization = os.getenv("OPENAI_ORGANIZATION")
+    openai.api_type = os.getenv("OPENAI_API_TYPE")
+    openai.api_base = os.getenv("OPENAI_API_BASE")
+    openai.api_version = os.getenv("OPENAI_API_VERSION")
+    return openai
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoder(model: str) -> "tiktoken.Encoding":
+    """Get the tokenizer for a model, building it only once per model.
+
+    Args:
+        model (str): The model name.
+    """
+    import tiktoken
+
+    return tiktoken.encoding_for_model(model)
+
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(model: str, text: str) -> int:
+    """Count the tokens of a text, reusing the count for texts seen before.
+
+    Args:
+        model (str): The model name.
+        text (str): The text to count.
+    """
+    return len(get_encoder(model).encode_ordinary(text))
+
+
+def get_api_cost(model: str, num_input_tokens: int, num_output_tokens: int) -> float:
+    """Get the API cost in USD of a request.
+
+    Args:
+        model (str): The model name.
+        num_input_tokens (int): The number of input tokens.
+        num_output_tokens (int): The number of output tokens.
+    """
+    if model not in API_PRICES:
+        raise ValueError(f"Unknown model: {model}")
+    input_price, output_price = API_PRICES[model]
+    return (input_price * num_input_tokens + output_price * num_output_tokens) / 1_000
+
+
+def get_retry_delay(attempt: int, error: "openai.error.OpenAIError") -> float:
+    """Get the number of seconds to wait before retrying an API call.
+
+    The delay follows the `Retry-After` header if the API sent one, and
+    otherwise grows exponentially with jitter.
+
+    Args:
+        attempt (int): The zero-based number of the failed attempt.
+        error (openai.error.OpenAIError): The error raised by the API call.
+    """
+    retry_after = (error.headers or {}).get("retry-after")
+    if retry_after is not None:
+        try:
+            return min(API_RETRY_MAX_SLEEP, float(retry_after))
+        except ValueError:
+            pass
+    return min(API_RETRY_MAX_SLEEP, 2**attempt + random.random())
+
 
+def load_cached_judgment(cache_file: Path) -> Optional[str]:
+    """Load a cached judgment.
 
-@dataclasses.dataclass
+    A missing or unreadable cache entry is treated as a cache miss.
+
+    Args:
+        cache_file (Path): The cache file.
+    """
+    if not cache_file.exists():
+        return None
+    try:
+        with open(cache_file, "r") as fin:
+            return json.load(fin)["judgment"]
+    except (json.JSONDecodeError, KeyError, TypeError):
+        logger.warning(f"Ignoring corrupt cache entry: {cache_file}")
+        return None
+
+
+def save_cached_judgment(cache_file: Path, judgment: str) -> None:
+    """Save a judgment to the cache.
+
+    Args:
+        cache_file (Path): The cache file.
+        judgment (str): The judgment.
+    """
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    # Write to a temporary file first so that an interrupted run never leaves a
+    # partially written entry behind.
+    with tempfile.NamedTemporaryFile(
+        "w", dir=cache_file.parent, suffix=".tmp", delete=False
+    ) as fout:
+        json.dump({"judgment": judgment}, fout, ensure_ascii=False)
+    os.replace(fout.name, cache_file)
+
+
+@dataclasses.dataclass(slots=True)
 class Judge:
     model: str
     prompt_template: dict
+    cache_dir: Optional[Path] = None
+    refresh_cache: bool = False
+    system_prompt_tokens: int = dataclasses.field(init=False, default=0)
+    prompt_template_tokens: int = dataclasses.field(init=False, default=0)
+
+    def __post_init__(self) -> None:
+        # The prompts are fixed per judge, so count their tokens only once.
+        self.system_prompt_tokens = count_tokens(
+            self.model, self.prompt_template["system_prompt"]
+        )
+        self.prompt_template_tokens = count_tokens(
+            self.model, self.prompt_template["prompt_template"]
+        )
+
+    def get_cache_key(self, **kwargs) -> str:
+        """Get the key identifying a judgment request in the cache.
+
+        Args:
+            **kwargs: The values filled into the prompt template.
+        """
+        request = {
+            "model": self.model,
+            "system_prompt": self.prompt_template["system_prompt"],
+            "prompt_template": self.prompt_template["prompt_template"],
+            "kwargs": kwargs,
+        }
+        return hashlib.blake2b(
+            json.dumps(request, sort_keys=True).encode(), digest_size=16
+        ).hexdigest()
 
     def judge(self, **kwargs):
+        return asyncio.run(self.judge_async(**kwargs))
+
+    def get_cache_file(self, **kwargs) -> Optional[Path]:
+        """Get the cache file of a judgment request, if caching is enabled.
+
+        Args:
+            **kwargs: The values filled into the prompt template.
+        """
+        if self.cache_dir is None:
+            return None
+        return Path(self.cache_dir) / f"{self.get_cache_key(**kwargs)}.json"
+
+    def is_cached(self, **kwargs) -> bool:
+        """Check whether a judgment request will be served from the cache.
+
+        Args:
+            **kwargs: The values filled into the prompt template.
+        """
+        cache_file = self.get_cache_file(**kwargs)
+        return cache_file is not None and not self.refresh_cache and cache_file.exists()
+
+    async def judge_async(self, **kwargs):
+        cache_file = self.get_cache_file(**kwargs)
+        if cache_file is not None and not self.refresh_cache:
+            judgment = await asyncio.to_thread(load_cached_judgment, cache_file)
+            if judgment is not None:
+                return judgment
+        judgment = await self.request_judgment(**kwargs)
+        if cache_file is not None:
+            await asyncio.to_thread(save_cached_judgment, cache_file, judgment)
+        return judgment
+
+    async def request_judgment(self, **kwargs):
+        openai = get_openai()
         messages = [
             {"role": "system", "content": self.prompt_template["system_prompt"]},
             {
@@ -57,7 +241,7 @@ class Judge:
                 "content": self.prompt_template["prompt_template"].format(**kwargs),
             },
         ]
-        for _ in range(API_MAX_RETRY):
+        for attempt in range(API_MAX_RETRY):
             try:
                 params = {
                     "messages": messages,
@@ -68,14 +252,24 @@ class Judge:
                     params["engine"] = self.model
                 else:
                     params["model"] = self.model
-                response = openai.ChatCompletion.create(**params)
+                response = await openai.ChatCompletion.acreate(**params)
                 return response["choices"][0]["message"]["content"]
+            except (
+                openai.error.AuthenticationError,
+                openai.error.InvalidRequestError,
+                openai.error.PermissionError,
+            ) as e:
+                logger.error(f"OpenAI API error: {e}")
+                raise
             except openai.error.OpenAIError as e:
+                if attempt == API_MAX_RETRY - 1:
+                    logger.error(f"OpenAI API error: {e}")
+                    raise
                 logger.warning(f"OpenAI API error: {e}")
-                time.sleep(API_RETRY_SLEEP)
+                await asyncio.sleep(get_retry_delay(attempt, e))
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class MatchSingle:
     question: dict
     model: str
@@ -95,13 +289,11 @@ class MatchSingle:
 
     def play(self):
         """Play a single match."""
-        kwargs = {
-            "question": self.question["turns"][0],
-            "answer": self.answer["choices"][0]["turns"][0],
-        }
-        if self.ref_answer:
-            kwargs["ref_answer_1"] = self.ref_answer["choices"][0]["turns"][0]
-        judgment = self.judge.judge(**kwargs)
+        return asyncio.run(self.play_async())
+
+    async def play_async(self):
+        """Play a single match asynchronously."""
+        judgment = await self.judge.judge_async(**self.get_judge_kwargs())
         score = self.get_score(judgment)
         return {
             "model": self.model,
@@ -116,39 +308,42 @@ class MatchSingle:
         }
 
     def estimate_cost(self) -> float:
-        enc = tiktoken.encoding_for_model(self.judge.model)
+        if self.judge.is_cached(**self.get_judge_kwargs()):
+            return 0.0
+        texts = [
+            self.question["turns"][0],
+            self.answer["choices"][0]["turns"][0],
+        ]
+        if self.ref_answer:
+            texts.append(self.ref_answer["choices"][0]["turns"][0])
         num_input_tokens = (
-            len(enc.encode(self.question["turns"][0]))
-            + len(enc.encode(self.answer["choices"][0]["turns"][0]))
-            + len(enc.encode(self.judge.prompt_template["system_prompt"]))
-            + len(enc.encode(self.judge.prompt_template["prompt_template"]))
+            sum(count_tokens(self.judge.model, text) for text in texts)
+            + self.judge.system_prompt_tokens
+            + self.judge.prompt_template_tokens
         )
-        if self.ref_answer:
-            num_input_tokens += len(
-                enc.encode(self.ref_answer["choices"][0]["turns"][0])
-            )
         num_output_tokens = 200  # Estimated from a few samples
-        if self.judge.model in {"gpt-4", "gpt-4-0613"}:
-            return (0.03 * num_input_tokens + 0.06 * num_output_tokens) / 1_000
-        elif self.judge.model == "gpt-4-1106-preview":
-            return (0.01 * num_input_tokens + 0.03 * num_output_tokens) / 1_000
-        elif self.judge.model == "gpt-3.5-turbo":
-            return (0.0005 * num_input_tokens + 0.0015 * num_output_tokens) / 1_000
-        raise AssertionError
+        return get_api_cost(self.judge.model, num_input_tokens, num_output_tokens)
+
+    def get_judge_kwargs(self) -> dict:
+        """Get the values filled into the judge prompt."""
+        kwargs = {
+            "question": self.question["turns"][0],
+            "answer": self.answer["choices"][0]["turns"][0],
+        }
+        if self.ref_answer:
+            kwargs["ref_answer_1"] = self.ref_answer["choices"][0]["turns"][0]
+        return kwargs
 
     @staticmethod
     def get_score(judgment: str) -> int:
-        match = (
-            re.search(one_score_pattern, judgment)
-            or re.search(one_score_pattern_another_format, judgment)
-            or re.search(one_score_pattern_another_format2, judgment)
-        )
+        match = one_score_pattern.search(judgment)
         if match:
-            return ast.literal_eval(match.groups()[0])
+            score = match.group(1) or match.group(2)
+            return float(score) if "." in score else int(score)
         return -1
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class MatchPair:
     question: dict
     model_1: str
@@ -170,21 +365,19 @@ class MatchPair:
 
     def play(self):
         """Play a pairwise match."""
+        return asyncio.run(self.play_async())
 
-        def play(answer_a, answer_b):
-            kwargs = {
-                "question": self.question["turns"][0],
-                "answer_a": answer_a["choices"][0]["turns"][0],
-                "answer_b": answer_b["choices"][0]["turns"][0],
-            }
-            if self.ref_answer is not None:
-                kwargs["ref_answer_1"] = self.ref_answer["choices"][0]["turns"][0]
-            return self.judge.judge(**kwargs)
-
-        g1_judgment = play(self.answer_1, self.answer_2)
+    async def play_async(self):
+        """Play a pairwise match asynchronously."""
+
+        async def play(answer_a, answer_b):
+            kwargs = self.get_judge_kwargs(answer_a, answer_b)
+            return await self.judge.judge_async(**kwargs)
+
+        g1_judgment = await play(self.answer_1, self.answer_2)
         g1_winner = self.get_winner(g1_judgment, model_a="model_1", model_b="model_2")
 
-        g2_judgment = play(self.answer_2, self.answer_1)
+        g2_judgment = await play(self.answer_2, self.answer_1)
         g2_winner = self.get_winner(g2_judgment, model_a="model_2", model_b="model_1")
 
         result = {
@@ -205,46 +398,81 @@ class MatchPair:
         return result
 
     def estimate_cost(self) -> float:
-        enc = tiktoken.encoding_for_model(self.judge.model)
-        num_input_tokens = (
-            len(enc.encode(self.question["turns"][0]))
-            + len(enc.encode(self.answer_1["choices"][0]["turns"][0]))
-            + len(enc.encode(self.answer_2["choices"][0]["turns"][0]))
-            + len(enc.encode(self.judge.prompt_template["system_prompt"]))
-            + len(enc.encode(self.judge.prompt_template["prompt_template"]))
+        # Each match plays two games, each sending both answers to the judge.
+        # Games with a cached judgment cost nothing.
+        num_uncached_games = sum(
+            not self.judge.is_cached(**self.get_judge_kwargs(answer_a, answer_b))
+            for answer_a, answer_b in [
+                (self.answer_1, self.answer_2),
+                (self.answer_2, self.answer_1),
+            ]
         )
+        if num_uncached_games == 0:
+            return 0.0
+        texts = [
+            self.question["turns"][0],
+            self.answer_1["choices"][0]["turns"][0],
+            self.answer_2["choices"][0]["turns"][0],
+        ]
         if self.ref_answer:
-            num_input_tokens += len(
-                enc.encode(self.ref_answer["choices"][0]["turns"][0])
-            )
+            texts.append(self.ref_answer["choices"][0]["turns"][0])
+        num_input_tokens = (
+            sum(count_tokens(self.judge.model, text) for text in texts)
+            + self.judge.system_prompt_tokens
+            + self.judge.prompt_template_tokens
+        )
         num_output_tokens = 200  # Estimated from a few samples
-        if self.judge.model in {"gpt-4", "gpt-4-0613"}:
-            return (0.03 * num_input_tokens + 0.06 * num_output_tokens) / 1_000
-        elif self.judge.model == "gpt-4-1106-preview":
-            return (0.01 * num_input_tokens + 0.03 * num_output_tokens) / 1_000
-        elif self.judge.model == "gpt-3.5-turbo":
-            return (0.0005 * num_input_tokens + 0.0015 * num_output_tokens) / 1_000
-        raise AssertionError
+        cost = get_api_cost(self.judge.model, num_input_tokens, num_output_tokens)
+        return cost * num_uncached_games
+
+    def get_judge_kwargs(self, answer_a: dict, answer_b: dict) -> dict:
+        """Get the values filled into the judge prompt.
+
+        Args:
+            answer_a (dict): The answer shown as assistant A.
+            answer_b (dict): The answer shown as assistant B.
+        """
+        kwargs = {
+            "question": self.question["turns"][0],
+            "answer_a": answer_a["choices"][0]["turns"][0],
+            "answer_b": answer_b["choices"][0]["turns"][0],
+        }
+        if self.ref_answer is not None:
+            kwargs["ref_answer_1"] = self.ref_answer["choices"][0]["turns"][0]
+        return kwargs
 
     @staticmethod
     def get_winner(judgment: str, model_a: str, model_b: str) -> str:
-        if "[[A]]" in judgment:
-            return model_a
-        elif "[[B]]" in judgment:
-            return model_b
-        elif "[[C]]" in judgment:
-            return "tie"
-        return "error"
+        match = winner_pattern.search(judgment)
+        if match is None:
+            return "error"
+        return {"A": model_a, "B": model_b, "C": "tie"}[match.group(1)]
 
 
 def load_questions(question_file: Union[str, Path]) -> list[dict]:
     """Load questions from a file.
 
+    The parsed questions are cached, so the returned question dicts are shared
+    between calls and must not be modified.
+
     Args:
         question_file (Union[str, Path]): The question file.
     """
-    with open(question_file, "r") as fin:
-        return [json.loads(line) for line in fin]
+    path = Path(question_file).resolve()
+    return list(_load_questions(str(path), path.stat().st_mtime_ns))
+
+
+@functools.lru_cache(maxsize=8)
+def _load_questions(question_file: str, mtime_ns: int) -> tuple[dict, ...]:
+    # `mtime_ns` is only part of the cache key so that edited files are reloaded.
+    if Path(question_file).stat().st_size == 0:
+        # An empty file cannot be memory-mapped.
+        return ()
+    with open(question_file, "rb") as fin:
+        with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return tuple(
+                orjson.loads(line) for line in iter(mm.readline, b"") if line.strip()
+            )
 
 
 def get_model_list(answer_dir: Union[str, Path]):
@@ -263,9 +491,9 @@ def load_model_answers(answer_dir: Union[str, Path]):
         answer_dir (Union[str, Path]): The answer directory.
     """
     answers = {}
-    with open(Path(answer_dir) / "results.jsonl", "r") as fin:
-        for line in fin:
-            answer = json.loads(line)
+    for line in (Path(answer_dir) / "results.jsonl").read_bytes().splitlines():
+        if line:
+            answer = orjson.loads(line)
             answers[answer["question_id"]] = answer
     return answers
 
@@ -288,11 +516,9 @@ def load_judgements(judgement_dir: Union[str, Path]):
     """
     judgements = {}
     for path in Path(judgement_dir).glob("*.jsonl"):
-        with open(path, "r") as fin:
-            results = []
-            for line in fin:
-                results.append(json.loads(line))
-            judgements[path.stem] = results
+        judgements[path.stem] = [
+            orjson.loads(line) for line in path.read_bytes().splitlines() if line
+        ]
     return judgements
 
 
@@ -303,9 +529,9 @@ def load_judge_prompts(prompt_file: Union[str, Path]):
         prompt_file (Union[str, Path]): The prompt file.
     """
     prompts = {}
-    with open(prompt_file) as fin:
+    with open(prompt_file, "rb") as fin:
         for line in fin:
-            line = json.loads(line)
+            line = orjson.loads(line)
             prompts[line["name"]] = line
     return prompts
 
@@ -321,12 +547,12 @@ def filter_single_judgements(
     """
     if model_list is None:
         return result_id_results_map
-    filtered_result_id_results_map = {}
-    for result_id, results in result_id_results_map.items():
-        result = results[0]
-        if result["model"] in model_list:
-            filtered_result_id_results_map[result_id] = results
-    return filtered_result_id_results_map
+    models = set(model_list)
+    return {
+        result_id: results
+        for result_id, results in result_id_results_map.items()
+        if results[0]["model"] in models
+    }
 
 
 def filter_pairwise_judgements(
@@ -341,25 +567,29 @@ def filter_pairwise_judgements(
         model_list (list[str], optional): A list of models. Defaults to None.
         baseline_model (str, optional): The baseline model. Defaults to None.
     """
-    filtered_result_id_results_map = {}
-    for result_id, results in result_id_results_map.items():
-        result = results[0]
-        if model_list and baseline_model:
-            if (
-                result["model_1"] in model_list and result["model_2"] == baseline_model
-            ) or (
-                result["model_2"] in model_list and result["model_1"] == baseline_model
-            ):
-                filtered_result_id_results_map[result_id] = results
-        elif model_list and baseline_model is None:
-            if result["model_1"] in model_list and result["model_2"] in model_list:
-                filtered_result_id_results_map[result_id] = results
-        elif model_list is None and baseline_model:
-            if (
-                result["model_1"] == baseline_model
-                or result["model_2"] == baseline_model
-            ):
-                filtered_result_id_results_map[result_id] = results
-        else:
-            filtered_result_id_results_map[result_id] = results
-    return filtered_result_id_results_map
+    if model_list and baseline_model:
+        models = set(model_list)
+
+        def is_target(result: dict) -> bool:
+            return (
+                result["model_1"] in models and result["model_2"] == baseline_model
+            ) or (result["model_2"] in models and result["model_1"] == baseline_model)
+
+    elif model_list and baseline_model is None:
+        models = set(model_list)
+
+        def is_target(result: dict) -> bool:
+            return result["model_1"] in models and result["model_2"] in models
+
+    elif model_list is None and baseline_model:
+
+        def is_target(result: dict) -> bool:
+            return baseline_model in {result["model_1"], result["model_2"]}
+
+    else:
+        return dict(result_id_results_map)
+    return {
+        result_id: results
+        for result_id, results in result_id_results_map.items()
+        if is_target(results[0])
+    }
@@ -1,21 +1,14 @@
 import argparse
 import json
 import logging
-import os
 import time
 
-import openai
 import shortuuid
-from common import PREDICTION_DIR, QUESTION_FILE, load_questions
-from dotenv import load_dotenv
+from common import PREDICTION_DIR, QUESTION_FILE, get_openai, load_questions
 from tqdm import tqdm
 
 logger = logging.getLogger(__name__)
 
-load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
-openai.organization = os.getenv("OPENAI_ORGANIZATION")
-
 
 def generate_response(input_text, generation_config) -> str:
     """Generate a response from the input text.
@@ -24,6 +17,7 @@ def generate_response(input_text, generation_config) -> str:
         input_text: The input text.
         generation_config: The config for the generation.
     """
+    openai = get_openai()
     response = openai.Completion.create(prompt=input_text, **generation_config)
     return response.choices[0].text
 
@@ -1,11 +1,15 @@
 import argparse
+import asyncio
+import functools
 import json
 import logging
-from concurrent.futures import ThreadPoolExecutor
 from itertools import combinations
-from typing import Optional
+from typing import Optional, Union
 
+import aiohttp
 from common import (
+    API_PRICES,
+    JUDGEMENT_CACHE_DIR,
     JUDGEMENT_DIR,
     JUDGEMENT_PROMPT_FILE,
     NEED_REF_CATS,
@@ -16,16 +20,41 @@ from common import (
     MatchPair,
     MatchSingle,
     get_model_list,
+    get_openai,
+    load_env,
     load_judge_prompts,
     load_model_answers,
     load_questions,
 )
-from tqdm import tqdm
+from tqdm.asyncio import tqdm_asyncio
 from upload_result import upload_results
 
 logger = logging.getLogger(__name__)
 
 
+async def play_matches(
+    matches: list[Union[MatchSingle, MatchPair]], parallel: int
+) -> list[dict]:
+    """Play matches concurrently.
+
+    Args:
+        matches (list): A list of matches.
+        parallel (int): The maximum number of matches played at the same time.
+    """
+    semaphore = asyncio.Semaphore(parallel)
+
+    async def play(match: Union[MatchSingle, MatchPair]) -> dict:
+        async with semaphore:
+            return await match.play_async()
+
+    # Share one connection pool across API calls instead of opening a new
+    # session (and TLS handshake) per request.
+    connector = aiohttp.TCPConnector(limit=parallel)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        get_openai().aiosession.set(session)
+        return await tqdm_asyncio.gather(*(play(match) for match in matches))
+
+
 def make_match_groups_single(
     questions: list[dict],
     model_answers: dict[str, dict[int, dict]],
@@ -116,6 +145,8 @@ def make_match_groups_pairwise(
 
 
 if __name__ == "__main__":
+    load_env()
+
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--mode",
@@ -133,7 +164,7 @@ if __name__ == "__main__":
         "--judge-model",
         type=str,
         default="gpt-4",
-        choices=["gpt-4", "gpt-4-0613", "gpt-4-1106-preview", "gpt-3.5-turbo"],
+        choices=list(API_PRICES),
         help="The judge model.",
     )
     parser.add_argument(
@@ -157,7 +188,17 @@ if __name__ == "__main__":
         "--yes", "-y", action="store_true", help="Skip confirmation and run."
     )
     parser.add_argument(
-        "--overwrite", action="store_true", help="Overwrite existing judgment files."
+        "--overwrite",
+        action="store_true",
+        help=(
+            "Overwrite existing judgment files. "
+            "Judgments are requested again and refresh the cache."
+        ),
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always call the API instead of reusing cached judgments.",
     )
     parser.add_argument(
         "--wandb",
@@ -220,13 +261,19 @@ if __name__ == "__main__":
     judge_prompts = load_judge_prompts(JUDGEMENT_PROMPT_FILE)
 
     logger.info("Make matches")
+    make_judge = functools.partial(
+        Judge,
+        args.judge_model,
+        cache_dir=None if args.no_cache else JUDGEMENT_CACHE_DIR,
+        refresh_cache=args.overwrite,
+    )
     if args.mode == "single":
         match_groups = make_match_groups_single(
             questions,
             model_answers,
             ref_answers=ref_answers,
-            judge_default=Judge(args.judge_model, judge_prompts["single"]),
-            judge_math=Judge(args.judge_model, judge_prompts["single-math"]),
+            judge_default=make_judge(judge_prompts["single"]),
+            judge_math=make_judge(judge_prompts["single-math"]),
         )
         output_dir = JUDGEMENT_DIR / "single" / args.judge_model
     else:
@@ -239,8 +286,8 @@ if __name__ == "__main__":
             questions,
             model_answers,
             ref_answers=ref_answers,
-            judge_default=Judge(args.judge_model, judge_prompts["pair"]),
-            judge_math=Judge(args.judge_model, judge_prompts["pair-math"]),
+            judge_default=make_judge(judge_prompts["pair"]),
+            judge_math=make_judge(judge_prompts["pair-math"]),
             baseline_model=baseline_model,
         )
         output_dir = JUDGEMENT_DIR / "pairwise" / args.judge_model
@@ -274,11 +321,7 @@ if __name__ == "__main__":
     logger.info("Play matches")
     for match_id, matches in match_groups.items():
         output_file = output_dir / f"{match_id}.jsonl"
-        results = []
-        with ThreadPoolExecutor(args.parallel) as executor:
-            futures = [executor.submit(match.play) for match in matches]
-            for future in tqdm(futures):
-                results.append(future.result())
+        results = asyncio.run(play_matches(matches, args.parallel))
 
         logger.info(f"Write {len(results)} judgments")
         output_file.parent.mkdir(parents=True, exist_ok=True)
@@ -9,6 +9,7 @@ from common import (
     PREDICTION_DIR,
     filter_pairwise_judgements,
     filter_single_judgements,
+    load_env,
     load_judgements,
     load_model_config,
 )
@@ -62,6 +63,7 @@ def upload_results(
         results: A list of results.
         baseline_model: Baseline model name. Only used in `pairwise-baseline` mode.
     """
+    load_env()
     project = os.getenv("WANDB_PROJECT", f"ja-vicuna-qa-benchmark-dev-{VERSION}")
     if len(results) == 0:
         logger.warning(f"No results found for {result_id}")
@@ -105,6 +107,8 @@ def upload_results(
 
 
 if __name__ == "__main__":
+    load_env()
+
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--mode",
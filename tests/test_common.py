@@ -1,6 +1,193 @@
+import asyncio
+import tempfile
 import unittest
+from pathlib import Path
+from unittest import mock
 
-from llm_judge.common import MatchPair, MatchSingle
+import openai
+
+from llm_judge.common import (
+    API_MAX_RETRY,
+    API_RETRY_MAX_SLEEP,
+    Judge,
+    MatchPair,
+    MatchSingle,
+    filter_pairwise_judgements,
+    get_retry_delay,
+    load_questions,
+)
+
+
+class TestGetRetryDelay(unittest.TestCase):
+    def test_get_retry_delay(self) -> None:
+        error = openai.error.RateLimitError(headers={"retry-after": "2"})
+        self.assertEqual(get_retry_delay(0, error), 2.0)
+
+        error = openai.error.RateLimitError(headers={"retry-after": "3600"})
+        self.assertEqual(get_retry_delay(0, error), API_RETRY_MAX_SLEEP)
+
+        error = openai.error.APIError()
+        self.assertGreaterEqual(get_retry_delay(2, error), 4)
+        self.assertLess(get_retry_delay(2, error), 5)
+        self.assertEqual(get_retry_delay(10, error), API_RETRY_MAX_SLEEP)
+
+
+def make_judge(**kwargs) -> Judge:
+    prompt_template = {
+        "name": "single",
+        "type": "single",
+        "output_format": "[[rating]]",
+        "system_prompt": "You are a judge.",
+        "prompt_template": "{question} {answer}",
+    }
+    # Skip tokenization, which downloads the tokenizer files.
+    with mock.patch("llm_judge.common.get_encoder"):
+        return Judge("gpt-4", prompt_template, **kwargs)
+
+
+class TestJudge(unittest.TestCase):
+    def test_judge_async_raises_non_retryable_error(self) -> None:
+        judge = make_judge()
+        error = openai.error.AuthenticationError("invalid key")
+        with mock.patch.object(
+            openai.ChatCompletion, "acreate", mock.AsyncMock(side_effect=error)
+        ) as acreate:
+            with self.assertRaises(openai.error.AuthenticationError):
+                asyncio.run(judge.judge_async(question="q", answer="a"))
+        self.assertEqual(acreate.call_count, 1)
+
+    def test_judge_async_raises_after_retries(self) -> None:
+        judge = make_judge()
+        error = openai.error.APIError("server error")
+        with (
+            mock.patch.object(
+                openai.ChatCompletion, "acreate", mock.AsyncMock(side_effect=error)
+            ) as acreate,
+            mock.patch("asyncio.sleep", mock.AsyncMock()),
+        ):
+            with self.assertRaises(openai.error.APIError):
+                asyncio.run(judge.judge_async(question="q", answer="a"))
+        self.assertEqual(acreate.call_count, API_MAX_RETRY)
+
+
+class TestJudgeCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = Path(self.temp_dir.name)
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def test_get_cache_key(self) -> None:
+        judge = make_judge()
+        key = judge.get_cache_key(question="q", answer="a")
+        self.assertEqual(key, judge.get_cache_key(answer="a", question="q"))
+        self.assertEqual(key, make_judge().get_cache_key(question="q", answer="a"))
+        self.assertNotEqual(key, judge.get_cache_key(question="q", answer="b"))
+
+    def test_judge_async_reuses_cached_judgment(self) -> None:
+        judge = make_judge(cache_dir=self.cache_dir)
+        with mock.patch.object(
+            Judge, "request_judgment", mock.AsyncMock(return_value="[[5]]")
+        ) as request_judgment:
+            self.assertFalse(judge.is_cached(question="q", answer="a"))
+            self.assertEqual(
+                asyncio.run(judge.judge_async(question="q", answer="a")), "[[5]]"
+            )
+            self.assertTrue(judge.is_cached(question="q", answer="a"))
+            self.assertEqual(
+                asyncio.run(judge.judge_async(question="q", answer="a")), "[[5]]"
+            )
+        self.assertEqual(request_judgment.call_count, 1)
+
+    def test_judge_async_refreshes_cache(self) -> None:
+        judge = make_judge(cache_dir=self.cache_dir)
+        refreshing_judge = make_judge(cache_dir=self.cache_dir, refresh_cache=True)
+        with mock.patch.object(
+            Judge, "request_judgment", mock.AsyncMock(side_effect=["[[5]]", "[[6]]"])
+        ):
+            asyncio.run(judge.judge_async(question="q", answer="a"))
+            self.assertFalse(refreshing_judge.is_cached(question="q", answer="a"))
+            self.assertEqual(
+                asyncio.run(refreshing_judge.judge_async(question="q", answer="a")),
+                "[[6]]",
+            )
+        self.assertEqual(
+            asyncio.run(judge.judge_async(question="q", answer="a")), "[[6]]"
+        )
+
+    def test_judge_async_ignores_corrupt_cache_entry(self) -> None:
+        judge = make_judge(cache_dir=self.cache_dir)
+        cache_file = judge.get_cache_file(question="q", answer="a")
+        cache_file.write_text('{"judgment": "[[')
+        with mock.patch.object(
+            Judge, "request_judgment", mock.AsyncMock(return_value="[[5]]")
+        ) as request_judgment:
+            self.assertEqual(
+                asyncio.run(judge.judge_async(question="q", answer="a")), "[[5]]"
+            )
+        self.assertEqual(request_judgment.call_count, 1)
+        self.assertEqual(
+            asyncio.run(judge.judge_async(question="q", answer="a")), "[[5]]"
+        )
+        self.assertEqual(list(self.cache_dir.iterdir()), [cache_file])
+
+    def test_judge_async_does_not_cache_errors(self) -> None:
+        judge = make_judge(cache_dir=self.cache_dir)
+        error = openai.error.APIError("server error")
+        with mock.patch.object(
+            Judge, "request_judgment", mock.AsyncMock(side_effect=error)
+        ):
+            with self.assertRaises(openai.error.APIError):
+                asyncio.run(judge.judge_async(question="q", answer="a"))
+        self.assertEqual(list(self.cache_dir.iterdir()), [])
+
+    def test_estimate_cost_skips_cached_judgment(self) -> None:
+        judge = make_judge(cache_dir=self.cache_dir)
+        match = MatchSingle(
+            question={"question_id": 1, "turns": ["q"]},
+            model="model",
+            answer={"choices": [{"turns": ["a"]}]},
+            judge=judge,
+        )
+        with mock.patch("llm_judge.common.count_tokens", return_value=100):
+            self.assertGreater(match.estimate_cost(), 0)
+            with mock.patch.object(
+                Judge, "request_judgment", mock.AsyncMock(return_value="[[5]]")
+            ):
+                match.play()
+            self.assertEqual(match.estimate_cost(), 0)
+
+    def test_estimate_cost_skips_cached_pairwise_game(self) -> None:
+        prompt_template = {
+            "name": "pair",
+            "type": "pairwise",
+            "output_format": "[[A]]",
+            "system_prompt": "You are a judge.",
+            "prompt_template": "{question} {answer_a} {answer_b}",
+        }
+        with mock.patch("llm_judge.common.get_encoder"):
+            judge = Judge("gpt-4", prompt_template, cache_dir=self.cache_dir)
+        answer_1 = {"choices": [{"turns": ["a1"]}]}
+        answer_2 = {"choices": [{"turns": ["a2"]}]}
+        match = MatchPair(
+            question={"question_id": 1, "turns": ["q"]},
+            model_1="model_1",
+            model_2="model_2",
+            answer_1=answer_1,
+            answer_2=answer_2,
+            judge=judge,
+        )
+        with mock.patch("llm_judge.common.count_tokens", return_value=100):
+            game_cost = match.estimate_cost() / 2
+            self.assertGreater(game_cost, 0)
+            with mock.patch.object(
+                Judge, "request_judgment", mock.AsyncMock(return_value="[[A]]")
+            ):
+                judge.judge(**match.get_judge_kwargs(answer_1, answer_2))
+                self.assertAlmostEqual(match.estimate_cost(), game_cost)
+                match.play()
+            self.assertEqual(match.estimate_cost(), 0)
 
 
 class TestMatchSingle(unittest.TestCase):
@@ -23,6 +210,10 @@ class TestMatchSingle(unittest.TestCase):
         judgement = "[[rating: Perfect]]"
         self.assertEqual(MatchSingle.get_score(judgement), -1)
 
+        # The leftmost score wins, whichever format it uses
+        judgement = "[[rating: 3]] ... [[7]]"
+        self.assertEqual(MatchSingle.get_score(judgement), 3)
+
 
 class TestMatchPair(unittest.TestCase):
     def test_get_winner(self):
@@ -60,3 +251,53 @@ class TestMatchPair(unittest.TestCase):
             MatchPair.get_winner(judgement, model_a="model_1", model_b="model_2"),
             "error",
         )
+
+        # The leftmost verdict wins
+        judgement = "[[B]] ... [[A]]"
+        self.assertEqual(
+            MatchPair.get_winner(judgement, model_a="model_1", model_b="model_2"),
+            "model_2",
+        )
+
+
+class TestLoadQuestions(unittest.TestCase):
+    def test_load_questions(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            question_file = Path(temp_dir) / "empty.jsonl"
+            question_file.write_text("")
+            self.assertEqual(load_questions(question_file), [])
+
+            question_file = Path(temp_dir) / "question.jsonl"
+            question_file.write_text('{"question_id": 1}\n{"question_id": 2}\n')
+            self.assertEqual(
+                load_questions(question_file), [{"question_id": 1}, {"question_id": 2}]
+            )
+
+
+class TestFilterPairwiseJudgements(unittest.TestCase):
+    def test_filter_pairwise_judgements(self):
+        result_id_results_map = {
+            "a_b": [{"model_1": "a", "model_2": "b"}],
+            "a_c": [{"model_1": "a", "model_2": "c"}],
+            "b_c": [{"model_1": "b", "model_2": "c"}],
+        }
+        self.assertEqual(
+            list(filter_pairwise_judgements(result_id_results_map)),
+            ["a_b", "a_c", "b_c"],
+        )
+        self.assertEqual(
+            list(filter_pairwise_judgements(result_id_results_map, ["a", "b"])),
+            ["a_b"],
+        )
+        self.assertEqual(
+            list(filter_pairwise_judgements(result_id_results_map, baseline_model="c")),
+            ["a_c", "b_c"],
+        )
+        self.assertEqual(
+            list(
+                filter_pairwise_judgements(
+                    result_id_results_map, ["b"], baseline_model="c"
+                )
+            ),
+            ["b_c"],
+        )
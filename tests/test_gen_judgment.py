@@ -0,0 +1,46 @@
+import asyncio
+import unittest
+
+from llm_judge.common import MatchSingle
+from llm_judge.gen_judgment import play_matches
+
+
+class StubJudge:
+    """A judge that echoes the question back as the score."""
+
+    model = "gpt-4"
+    prompt_template = {
+        "name": "single",
+        "type": "single",
+        "output_format": "[[rating]]",
+    }
+
+    def __init__(self) -> None:
+        self.num_running = 0
+        self.max_num_running = 0
+
+    async def judge_async(self, **kwargs):
+        self.num_running += 1
+        self.max_num_running = max(self.max_num_running, self.num_running)
+        # Let earlier questions finish later to shuffle the completion order.
+        await asyncio.sleep(0.001 * (10 - int(kwargs["question"])))
+        self.num_running -= 1
+        return f"[[{kwargs['question']}]]"
+
+
+class TestPlayMatches(unittest.TestCase):
+    def test_play_matches(self):
+        judge = StubJudge()
+        matches = [
+            MatchSingle(
+                question={"question_id": i, "turns": [str(i)]},
+                model="model",
+                answer={"choices": [{"turns": ["answer"]}]},
+                judge=judge,
+            )
+            for i in range(10)
+        ]
+        results = asyncio.run(play_matches(matches, parallel=3))
+        self.assertEqual([result["question_id"] for result in results], list(range(10)))
+        self.assertEqual([result["score"] for result in results], list(range(10)))
+        self.assertEqual(judge.max_num_running, 3)